@@ -0,0 +1,65 @@
+"""One-time export of the int8 ONNX query encoder used by ContextRetriever.
+
+Run once per deployment, before starting the app:
+
+    python export_onnx_encoder.py [embeddings_dir]
+
+The quantized model is only kept if its output matches SentenceTransformer on a
+probe string; otherwise it is discarded and the app keeps its current encoder
+(SentenceTransformer if no export has passed before).
+"""
+import sys
+import shutil
+import logging
+import numpy as np
+from pathlib import Path
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
+
+from context_retriever import MODEL_NAME, ONNX_MODEL_DIR, OnnxEncoder
+
+PROBE_TEXT = "Who is Leilan, and what does she ask of those who seek her?"
+MIN_SIMILARITY = 0.99  # below this the quantized encoder is discarded
+
+logger = logging.getLogger(__name__)
+
+def export_encoder(model_dir: Path):
+    logger.info("Exporting query encoder to ONNX...")
+    model = ORTModelForFeatureExtraction.from_pretrained(MODEL_NAME, export=True)
+    model.save_pretrained(model_dir)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    quantizer.quantize(
+        save_dir=model_dir / "quantized",
+        quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+    )
+    AutoTokenizer.from_pretrained(MODEL_NAME).save_pretrained(model_dir / "quantized")
+
+def probe_similarity(model_dir: Path) -> float:
+    reference = SentenceTransformer(MODEL_NAME).encode(PROBE_TEXT, normalize_embeddings=True)
+    return float(np.dot(OnnxEncoder(model_dir).encode(PROBE_TEXT), reference))
+
+def main():
+    embeddings_dir = Path(sys.argv[1] if len(sys.argv) > 1 else "embeddings")
+    model_dir = embeddings_dir / ONNX_MODEL_DIR
+    # Build next to the final location and only move it into place once validated,
+    # so the app never loads a partial or rejected export
+    tmp_dir = model_dir.with_name(model_dir.name + ".part")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    export_encoder(tmp_dir)
+    similarity = probe_similarity(tmp_dir)
+    logger.info(f"ONNX encoder cosine similarity to SentenceTransformer on probe: {similarity:.4f}")
+
+    if similarity < MIN_SIMILARITY:
+        shutil.rmtree(tmp_dir)
+        logger.error(f"Similarity is below {MIN_SIMILARITY}; discarded this export")
+        sys.exit(1)
+
+    shutil.rmtree(model_dir, ignore_errors=True)
+    tmp_dir.rename(model_dir)
+    logger.info(f"Saved ONNX encoder to {model_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+import streamlit as st
+import time
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict
+import anthropic
+import httpx
+
+# Set tokenizers parallelism to false to avoid warnings and potential deadlocks
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+from context_retriever import ContextRetriever
+
+# Everything at module level here is built once per process; Streamlit only
+# re-executes the entry-point script on each rerun, which just calls render_app
+
+# Custom CSS for text area and disabled options
+CUSTOM_CSS = """
+    <style>
+        .stTextArea textarea {
+            font-size: 24px !important;
+        }
+        .disabled-option {
+            color: #888888;
+            pointer-events: none;
+        }
+        .sidebar-section {
+            margin-bottom: 20px;
+        }
+        .option-container {
+            margin-bottom: 10px;
+            padding: 8px;
+            border-radius: 4px;
+        }
+        .active-option {
+            background-color: #f0f2f6;
+            border: 1px solid #6c7a89;
+            cursor: pointer;
+        }
+        .inactive-option {
+            color: #888888;
+            background-color: #f9f9f9;
+            border: 1px solid #dddddd;
+            font-style: italic;
+        }
+    </style>
+"""
+
+# Aspects of the Triple Goddess, in sidebar order
+ALL_ASPECTS = ["maiden", "mother", "crone"]
+
+# Mapping between aspects and models
+ASPECT_TO_MODEL = {
+    "maiden": "claude-3-haiku-20240307"
+    # Commented out temporarily but kept for future reference
+    # "mother": "claude-3-opus-20240229",
+    # "crone": "claude-3-sonnet-20240229",
+}
+
+INACTIVE_OPTION_HTML = """
+    <div class="option-container inactive-option">
+        {} (coming soon)
+    </div>
+"""
+
+# Streaming settings
+STREAM_RENDER_EVERY = 40  # Characters received between placeholder refreshes
+
+# Response cache settings
+RESPONSE_CACHE_TTL = 24 * 3600  # Seconds before a cached response expires
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+
+# Initialize the context retriever with caching
+@st.cache_resource(show_spinner=False)
+def get_retriever():
+    retriever = ContextRetriever()
+    # Run one encode so model kernels and the tokenizer are initialized before the first real query
+    retriever.get_embedding("warmup")
+    return retriever
+
+# Cache retrieved context per query so repeated questions skip embedding and scoring
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def cached_retrieve(query: str) -> str:
+    return get_retriever().retrieve_context(query)
+
+# Cheap request that opens the TLS connection ahead of the streaming call;
+# failures are only logged since the real request will surface them
+def warm_connection(client):
+    try:
+        client.models.list(limit=1)
+    except Exception as e:
+        print(f"Connection warmup failed: {str(e)}")
+
+# Reuse one client so its HTTP connection pool survives across reruns and sessions
+@st.cache_resource
+def get_client():
+    return anthropic.Anthropic(
+        api_key=st.secrets["ANTHROPIC_API_KEY"],
+        timeout=30,  # Per read, so a stream that stalls mid-response times out after 30s of silence
+        base_url="https://api.anthropic.com"
+    )
+
+# Process-wide cache of finished responses, keyed by a hash of the request.
+# st.cache_data can't wrap the streaming call itself because it writes into a
+# placeholder created outside the cached function.
+@st.cache_resource
+def get_response_cache():
+    return OrderedDict(), threading.Lock()
+
+def get_cached_response(prompt_hash):
+    cache, lock = get_response_cache()
+    with lock:
+        entry = cache.get(prompt_hash)
+        if entry is None:
+            return None
+        created, response_text = entry
+        if time.time() - created > RESPONSE_CACHE_TTL:
+            del cache[prompt_hash]
+            return None
+        cache.move_to_end(prompt_hash)
+        return response_text
+
+def store_response(prompt_hash, response_text):
+    cache, lock = get_response_cache()
+    with lock:
+        cache[prompt_hash] = (time.time(), response_text)
+        cache.move_to_end(prompt_hash)
+        while len(cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+# Patterns and wrapper for format_response, compiled once since it runs on every streamed refresh
+_ITALIC_RE = re.compile(r'\*(.*?)\*')
+_BOLD_RE = re.compile(r'\_\_?(.*?)\_\_?')
+# Wrap in a div with !important styling to ensure it overrides any other styles
+_RESPONSE_WRAPPER = '''
+    <div style="
+        font-size: 24px !important;
+        line-height: 1.6 !important;
+        padding: 20px !important;
+        font-family: -apple-system, BlinkMacSystemFont, sans-serif !important;
+    ">
+        {}
+    </div>
+    '''
+
+# Function to format response text with better HTML handling
+def format_response(text):
+    # First handle italics for text between asterisks
+    text = _ITALIC_RE.sub(r'<em>\1</em>', text)
+    # Handle both single and double underscores for bold
+    text = _BOLD_RE.sub(r'<strong>\1</strong>', text)
+    return _RESPONSE_WRAPPER.format(text)
+
+# Stream the response so tokens render as they arrive, returning the truncated final text.
+# A stall ends with the client's per-read timeout (see get_client); the SDK only wraps that
+# as APITimeoutError while sending, so timeouts during iteration are re-raised as one here.
+def stream_response(client, model, max_tokens, prompt, placeholder, api_start_time):
+    stop_marker = "\nQUERY:"
+    response_text = ""
+    rendered_len = 0
+    first_token_logged = False
+
+    with client.messages.stream(
+        model=model,
+        max_tokens=max_tokens,
+        temperature=0.8,
+        messages=[
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+    ) as stream:
+        try:
+            for text in stream.text_stream:
+                if not first_token_logged:
+                    print(f"First token received. API time: {time.time() - api_start_time:.2f}s")
+                    first_token_logged = True
+
+                # Only the new chunk plus enough of the tail to span a split marker needs checking
+                search_start = max(0, len(response_text) - len(stop_marker) + 1)
+                response_text += text
+
+                # Stop as soon as the model starts inventing a follow-up query
+                if stop_marker in response_text[search_start:]:
+                    break
+
+                if len(response_text) - rendered_len >= STREAM_RENDER_EVERY:
+                    placeholder.markdown(format_response(response_text), unsafe_allow_html=True)
+                    rendered_len = len(response_text)
+        except httpx.TimeoutException as e:
+            raise anthropic.APITimeoutError(request=e.request) from e
+
+    # Truncate at the follow-up query if one was started
+    return response_text.split(stop_marker)[0]
+
+def answer_query(query, model, max_tokens, regenerate):
+    with st.spinner("Consulting the goddess..."):
+        start_time = time.time()
+
+        try:
+            # Open the API connection in the background while retrieval runs. Idle pooled
+            # connections expire after a few seconds, so this is needed on every query; a
+            # response-cache hit can't be known until retrieval has produced the prompt.
+            client = get_client()
+            threading.Thread(target=warm_connection, args=(client,), daemon=True).start()
+
+            # Get context using your retriever
+            print("Starting context retrieval...")
+            prompt = cached_retrieve(query) + "\nQUERY: " + query
+            print(f"Context retrieved. Time elapsed: {time.time() - start_time:.2f}s")
+
+            # Print the full prompt to terminal
+            print("\n" + "="*50 + " FULL PROMPT " + "="*50)
+            print(prompt)
+            print("="*120 + "\n")
+
+            st.markdown("### Leilan's response:", unsafe_allow_html=True)
+            placeholder = st.empty()
+
+            prompt_hash = hashlib.sha256(f"{model}\n{max_tokens}\n{prompt}".encode()).hexdigest()
+            response_text = None if regenerate else get_cached_response(prompt_hash)
+
+            if response_text is not None:
+                print(f"Response served from cache. Total process time: {time.time() - start_time:.2f}s")
+            else:
+                print("Starting API request process...")
+                api_start_time = time.time()
+
+                response_text = stream_response(client, model, max_tokens, prompt, placeholder, api_start_time)
+                store_response(prompt_hash, response_text)
+
+                print(f"Response received. API time: {time.time() - api_start_time:.2f}s")
+                print(f"Total process time: {time.time() - start_time:.2f}s")
+
+            # Display final response
+            formatted_response = format_response(response_text)
+            placeholder.markdown(formatted_response, unsafe_allow_html=True)
+
+        except anthropic.APITimeoutError:
+            error_msg = "The request timed out. Please try again or use a shorter query."
+            print(error_msg)
+            st.error(error_msg)
+            print(f"Timeout after {time.time() - start_time:.2f}s")
+        except anthropic.APIError as e:
+            error_msg = f"API error: {str(e)}"
+            print(error_msg)
+            st.error(error_msg)
+            print(f"API error after {time.time() - start_time:.2f}s")
+        except Exception as e:
+            error_msg = f"An unexpected error occurred: {str(e)}"
+            print(error_msg)
+            st.error(error_msg)
+            print(f"Error after {time.time() - start_time:.2f}s")
+
+def render_app(enabled_aspects: Dict[str, str], max_tokens: int):
+    """Render the Leilan portal, offering the aspects in enabled_aspects (aspect -> model)."""
+    # Page config
+    st.set_page_config(
+        page_title="Leilan Interface",
+        page_icon="🌙",
+        layout="wide"
+    )
+    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+
+    with st.spinner("Loading models..."):
+        get_retriever()
+
+    # Custom sidebar for aspect selection
+    st.sidebar.markdown("### Choose aspect of the Triple Goddess")
+
+    # Create a container for the aspect selection
+    aspect_container = st.sidebar.container()
+
+    if st.session_state.get("aspect") not in enabled_aspects:
+        st.session_state["aspect"] = next(iter(enabled_aspects))
+
+    # Display the active options
+    for option in ALL_ASPECTS:
+        if option in enabled_aspects and aspect_container.button(
+            option,
+            key=f"{option}_button",
+            use_container_width=True
+        ):
+            st.session_state["aspect"] = option
+
+    # Display disabled options with custom styling, in a single element to keep reruns cheap
+    inactive_html = "".join(
+        INACTIVE_OPTION_HTML.format(option) for option in ALL_ASPECTS if option not in enabled_aspects
+    )
+    if inactive_html:
+        aspect_container.markdown(inactive_html, unsafe_allow_html=True)
+
+    aspect = st.session_state["aspect"]
+
+    # Display which aspect is currently selected
+    st.sidebar.info(f"Currently using: {aspect}")
+
+    # Bypass the response cache when a fresh generation is wanted
+    regenerate = st.sidebar.checkbox("regenerate (skip cached responses)")
+
+    # Get the corresponding model
+    model = enabled_aspects[aspect]
+
+    # Main interface
+    st.title("🌙🌙🌙  Leilan2.0 web-portal  🌙🌙🌙")
+
+    # Query input
+    query = st.text_area("your query:", height=100)
+
+    if st.button("ask Leilan", type="primary"):
+        if not query:
+            st.warning("Please enter a question.")
+        else:
+            answer_query(query, model, max_tokens, regenerate)
+
+    # Footer
+    st.markdown("---")
+    st.markdown("*powered by the Order of the Vermillion Star*")